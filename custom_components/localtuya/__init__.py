@@ -15,20 +15,19 @@ from homeassistant.const import (
     CONF_DEVICES,
     CONF_ENTITIES,
     CONF_HOST,
-    CONF_ID,
     CONF_PLATFORM,
     CONF_REGION,
     CONF_USERNAME,
     EVENT_HOMEASSISTANT_STOP,
     SERVICE_RELOAD,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.exceptions import HomeAssistantError
 from homeassistant.helpers.device_registry import DeviceEntry
 from homeassistant.helpers.event import async_track_time_interval
 
 from .cloud_api import TuyaCloudApi
-from .common import TuyaDevice, async_config_entry_by_device_id
+from .common import TuyaDevice, async_config_entry_by_device_id, now_ms_str
 from .config_flow import ENTRIES_VERSION, config_schema
 from .const import (
     ATTR_UPDATED_AT,
@@ -44,9 +43,13 @@ from .discovery import TuyaDiscovery
 
 _LOGGER = logging.getLogger(__name__)
 
-UNSUB_LISTENER = "unsub_listener"
+UNKNOWN_DEVICES = "unknown_devices"
+MIGRATION_DONE = "migration_done"
 
 RECONNECT_INTERVAL = timedelta(seconds=60)
+UNKNOWN_DEVICE_TTL = 60
+ENTRY_UPDATE_THROTTLE = 5
+MIGRATION_TIMEOUT = 5
 
 CONFIG_SCHEMA = config_schema()
 
@@ -63,12 +66,38 @@ SERVICE_SET_DP_SCHEMA = vol.Schema(
 )
 
 
+def _migration_pending(hass):
+    """Return whether some config entries still have to be migrated."""
+    # Disabled entries are not migrated by Home Assistant
+    return any(
+        entry.version < ENTRIES_VERSION and not entry.disabled_by
+        for entry in hass.config_entries.async_entries(DOMAIN)
+    )
+
+
+async def _wait_migration(hass):
+    """Wait for pending config entries to be merged by the migration."""
+    migration_done = hass.data[DOMAIN][MIGRATION_DONE]
+    try:
+        await asyncio.wait_for(migration_done.wait(), MIGRATION_TIMEOUT)
+    except asyncio.TimeoutError:
+        _LOGGER.warning("Timed out waiting for config entries migration")
+        # Don't wait again on later setups, e.g. if a migration failed
+        migration_done.set()
+
+
 async def async_setup(hass: HomeAssistant, config: dict):
     """Set up the LocalTuya integration component."""
-    hass.data.setdefault(DOMAIN, {})
-    hass.data[DOMAIN][TUYA_DEVICES] = {}
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    domain_data[TUYA_DEVICES] = {}
 
     device_cache = {}
+    entry_updates = {}
+    unknown_devices = domain_data[UNKNOWN_DEVICES] = {}
+
+    migration_done = domain_data[MIGRATION_DONE] = asyncio.Event()
+    if not _migration_pending(hass):
+        migration_done.set()
 
     async def _handle_reload(service):
         """Handle reload service call."""
@@ -85,50 +114,58 @@ async def async_setup(hass: HomeAssistant, config: dict):
 
     async def _handle_set_dp(event):
         """Handle set_dp service call."""
-        dev_id = event.data[CONF_DEVICE_ID]
-        if dev_id not in hass.data[DOMAIN][TUYA_DEVICES]:
+        data = event.data
+        device = domain_data[TUYA_DEVICES].get(data[CONF_DEVICE_ID])
+        if device is None:
             raise HomeAssistantError("unknown device id")
 
-        device = hass.data[DOMAIN][TUYA_DEVICES][dev_id]
         if not device.connected:
             raise HomeAssistantError("not connected to device")
 
-        await device.set_dp(event.data[CONF_VALUE], event.data[CONF_DP])
+        await device.set_dp(data[CONF_VALUE], data[CONF_DP])
 
+    @callback
     def _device_discovered(device):
         """Update address of device if it has changed."""
         device_ip = device["ip"]
         device_id = device["gwId"]
         product_key = device["productKey"]
 
+        # Skip registry lookups for devices recently found not to be configured
+        now = time.monotonic()
+        last_miss = unknown_devices.get(device_id)
+        if last_miss is not None and now - last_miss < UNKNOWN_DEVICE_TTL:
+            return
+
         # If device is not in cache, check if a config entry exists
         entry = async_config_entry_by_device_id(hass, device_id)
         if entry is None:
-            return
-
-        if device_id not in device_cache:
-            if entry and device_id in entry.data[CONF_DEVICES]:
-                # Save address from config entry in cache to trigger
-                # potential update below
-                host_ip = entry.data[CONF_DEVICES][device_id][CONF_HOST]
-                device_cache[device_id] = host_ip
-
-        if device_id not in device_cache:
+            unknown_devices[device_id] = now
             return
 
         dev_entry = entry.data[CONF_DEVICES][device_id]
 
-        new_data = entry.data.copy()
-        updated = False
+        # Save address from config entry in cache to trigger potential update below
+        cached_ip = device_cache.get(device_id)
+        if cached_ip is None:
+            cached_ip = device_cache[device_id] = dev_entry[CONF_HOST]
 
-        if device_cache[device_id] != device_ip:
-            updated = True
-            new_data[CONF_DEVICES][device_id][CONF_HOST] = device_ip
-            device_cache[device_id] = device_ip
+        updated = (
+            cached_ip != device_ip or dev_entry.get(CONF_PRODUCT_KEY) != product_key
+        )
 
-        if dev_entry.get(CONF_PRODUCT_KEY) != product_key:
-            updated = True
-            new_data[CONF_DEVICES][device_id][CONF_PRODUCT_KEY] = product_key
+        # Each update reloads the entry; skip writes within ENTRY_UPDATE_THROTTLE of
+        # the last one. A later broadcast retries since device_cache only advances
+        # on write.
+        last_update = entry_updates.get(device_id)
+        if (
+            updated
+            and last_update is not None
+            and now - last_update < ENTRY_UPDATE_THROTTLE
+        ):
+            return
+
+        device = domain_data[TUYA_DEVICES].get(device_id)
 
         # Update settings if something changed, otherwise try to connect. Updating
         # settings triggers a reload of the config entry, which tears down the device
@@ -137,26 +174,37 @@ async def async_setup(hass: HomeAssistant, config: dict):
             _LOGGER.debug(
                 "Updating keys for device %s: %s %s", device_id, device_ip, product_key
             )
-            new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+            device_cache[device_id] = device_ip
+            entry_updates[device_id] = now
+            # Copy the nested dicts too, rather than writing the new values into the
+            # live entry data in place, outside of async_update_entry.
+            new_data = entry.data.copy()
+            new_data[CONF_DEVICES] = new_data[CONF_DEVICES].copy()
+            new_data[CONF_DEVICES][device_id] = {
+                **dev_entry,
+                CONF_HOST: device_ip,
+                CONF_PRODUCT_KEY: product_key,
+            }
+            new_data[ATTR_UPDATED_AT] = now_ms_str()
             hass.config_entries.async_update_entry(entry, data=new_data)
 
-        elif device_id in hass.data[DOMAIN][TUYA_DEVICES]:
+        elif device is not None:
             _LOGGER.debug("Device %s found with IP %s", device_id, device_ip)
 
-        device = hass.data[DOMAIN][TUYA_DEVICES].get(device_id)
-        if not device:
+        if device is None:
             _LOGGER.warning(f"Could not find device for device_id {device_id}")
         elif not device.connected:
             device.async_connect()
 
-
     def _shutdown(event):
         """Clean up resources when shutting down."""
         discovery.close()
 
-    async def _async_reconnect(now):
+    @callback
+    def _async_reconnect(now):
         """Try connecting to devices not already connected to."""
-        for device_id, device in hass.data[DOMAIN][TUYA_DEVICES].items():
+        # Iterate over a snapshot, devices may be added or removed while connecting
+        for device in tuple(domain_data[TUYA_DEVICES].values()):
             if not device.connected:
                 device.async_connect()
 
@@ -175,7 +223,7 @@ async def async_setup(hass: HomeAssistant, config: dict):
     discovery = TuyaDiscovery(_device_discovered)
     try:
         await discovery.start()
-        hass.data[DOMAIN][DATA_DISCOVERY] = discovery
+        domain_data[DATA_DISCOVERY] = discovery
         hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _shutdown)
     except Exception:  # pylint: disable=broad-except
         _LOGGER.exception("failed to set up discovery")
@@ -186,11 +234,11 @@ async def async_setup(hass: HomeAssistant, config: dict):
 async def async_migrate_entry(hass, config_entry: ConfigEntry):
     """Migrate old entries merging all of them in one."""
     new_version = ENTRIES_VERSION
-    stored_entries = hass.config_entries.async_entries(DOMAIN)
+    primary = hass.config_entries.async_entries(DOMAIN)[0]
     if config_entry.version == 1:
         _LOGGER.debug("Migrating config entry from version %s", config_entry.version)
 
-        if config_entry.entry_id == stored_entries[0].entry_id:
+        if config_entry.entry_id == primary.entry_id:
             _LOGGER.debug(
                 "Migrating the first config entry (%s)", config_entry.entry_id
             )
@@ -204,7 +252,7 @@ async def async_migrate_entry(hass, config_entry: ConfigEntry):
             new_data[CONF_DEVICES] = {
                 config_entry.data[CONF_DEVICE_ID]: config_entry.data.copy()
             }
-            new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+            new_data[ATTR_UPDATED_AT] = now_ms_str()
             config_entry.version = new_version
             hass.config_entries.async_update_entry(
                 config_entry, title=DOMAIN, data=new_data
@@ -213,12 +261,12 @@ async def async_migrate_entry(hass, config_entry: ConfigEntry):
             _LOGGER.debug(
                 "Merging the config entry %s into the main one", config_entry.entry_id
             )
-            new_data = stored_entries[0].data.copy()
-            new_data[CONF_DEVICES].update(
-                {config_entry.data[CONF_DEVICE_ID]: config_entry.data.copy()}
-            )
-            new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
-            hass.config_entries.async_update_entry(stored_entries[0], data=new_data)
+            new_data = dict(primary.data)
+            devices = dict(new_data[CONF_DEVICES])
+            devices[config_entry.data[CONF_DEVICE_ID]] = dict(config_entry.data)
+            new_data[CONF_DEVICES] = devices
+            new_data[ATTR_UPDATED_AT] = now_ms_str()
+            hass.config_entries.async_update_entry(primary, data=new_data)
             await hass.config_entries.async_remove(config_entry.entry_id)
 
     _LOGGER.info(
@@ -227,6 +275,9 @@ async def async_migrate_entry(hass, config_entry: ConfigEntry):
         new_version,
     )
 
+    if not _migration_pending(hass):
+        hass.data[DOMAIN][MIGRATION_DONE].set()
+
     return True
 
 
@@ -245,13 +296,11 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     secret = entry.data[CONF_CLIENT_SECRET]
     user_id = entry.data[CONF_USER_ID]
     tuya_api = TuyaCloudApi(hass, region, client_id, secret, user_id)
-    no_cloud = True
-    if CONF_NO_CLOUD in entry.data:
-        no_cloud = entry.data.get(CONF_NO_CLOUD)
+    no_cloud = entry.data.get(CONF_NO_CLOUD, True)
     if no_cloud:
         _LOGGER.info("Cloud API account not configured.")
-        # wait 1 second to make sure possible migration has finished
-        await asyncio.sleep(1)
+        # make sure possible migration has finished
+        await _wait_migration(hass)
     else:
         res = await tuya_api.async_get_access_token()
         if res != "ok":
@@ -262,12 +311,12 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     hass.data[DOMAIN][DATA_CLOUD] = tuya_api
 
     async def setup_entities(device_ids):
-        platforms = set()
+        platforms = {
+            entity[CONF_PLATFORM]
+            for dev_id in device_ids
+            for entity in entry.data[CONF_DEVICES][dev_id][CONF_ENTITIES]
+        }
         for dev_id in device_ids:
-            entities = entry.data[CONF_DEVICES][dev_id][CONF_ENTITIES]
-            platforms = platforms.union(
-                set(entity[CONF_PLATFORM] for entity in entities)
-            )
             hass.data[DOMAIN][TUYA_DEVICES][dev_id] = TuyaDevice(hass, entry, dev_id)
 
         # Setup all platforms at once, letting HA handling each platform and avoiding
@@ -277,37 +326,37 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
         for dev_id in device_ids:
             hass.data[DOMAIN][TUYA_DEVICES][dev_id].async_connect()
 
-        await async_remove_orphan_entities(hass, entry)
-
     hass.async_create_task(setup_entities(entry.data[CONF_DEVICES].keys()))
 
-    unsub_listener = entry.add_update_listener(update_listener)
-    hass.data[DOMAIN][entry.entry_id] = {UNSUB_LISTENER: unsub_listener}
+    # Devices may have been added to the entry, forget about previous misses
+    hass.data[DOMAIN][UNKNOWN_DEVICES].clear()
+
+    entry.async_on_unload(entry.add_update_listener(update_listener))
 
     return True
 
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Unload a config entry."""
-    platforms = {}
-
-    for dev_id, dev_entry in entry.data[CONF_DEVICES].items():
-        for entity in dev_entry[CONF_ENTITIES]:
-            platforms[entity[CONF_PLATFORM]] = True
-
-    unload_ok = all(
-        await asyncio.gather(
-            *[
-                hass.config_entries.async_forward_entry_unload(entry, component)
-                for component in platforms
-            ]
-        )
-    )
+    platforms = {
+        entity[CONF_PLATFORM]
+        for dev_entry in entry.data[CONF_DEVICES].values()
+        for entity in dev_entry[CONF_ENTITIES]
+    }
 
-    hass.data[DOMAIN][entry.entry_id][UNSUB_LISTENER]()
-    for dev_id, device in hass.data[DOMAIN][TUYA_DEVICES].items():
-        if device.connected:
-            await device.close()
+    unload_ok = await hass.config_entries.async_unload_platforms(entry, platforms)
+
+    connected = [
+        (dev_id, device)
+        for dev_id, device in hass.data[DOMAIN][TUYA_DEVICES].items()
+        if device.connected
+    ]
+    results = await asyncio.gather(
+        *[device.close() for _, device in connected], return_exceptions=True
+    )
+    for (dev_id, _), result in zip(connected, results):
+        if isinstance(result, BaseException):
+            _LOGGER.warning("Failed to close device %s: %r", dev_id, result)
 
     if unload_ok:
         hass.data[DOMAIN][TUYA_DEVICES] = {}
@@ -324,16 +373,14 @@ async def async_remove_config_entry_device(
     hass: HomeAssistant, config_entry: ConfigEntry, device_entry: DeviceEntry
 ) -> bool:
     """Remove a config entry from a device."""
-    dev_id = list(device_entry.identifiers)[0][1].split("_")[-1]
+    _, identifier = next(iter(device_entry.identifiers))
+    dev_id = identifier.rpartition("_")[2]
 
     ent_reg = er.async_get(hass)
-    entities = {
-        ent.unique_id: ent.entity_id
-        for ent in er.async_entries_for_config_entry(ent_reg, config_entry.entry_id)
-        if dev_id in ent.unique_id
-    }
-    for entity_id in entities.values():
-        ent_reg.async_remove(entity_id)
+    remove_entity = ent_reg.async_remove
+    for ent in er.async_entries_for_config_entry(ent_reg, config_entry.entry_id):
+        if dev_id in ent.unique_id:
+            remove_entity(ent.entity_id)
 
     if dev_id not in config_entry.data[CONF_DEVICES]:
         _LOGGER.info(
@@ -345,7 +392,7 @@ async def async_remove_config_entry_device(
 
     new_data = config_entry.data.copy()
     new_data[CONF_DEVICES].pop(dev_id)
-    new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+    new_data[ATTR_UPDATED_AT] = now_ms_str()
 
     hass.config_entries.async_update_entry(
         config_entry,
@@ -355,22 +402,3 @@ async def async_remove_config_entry_device(
     _LOGGER.info("Device %s removed.", dev_id)
 
     return True
-
-
-async def async_remove_orphan_entities(hass, entry):
-    """Remove entities associated with config entry that has been removed."""
-    return
-    ent_reg = er.async_get(hass)
-    entities = {
-        ent.unique_id: ent.entity_id
-        for ent in er.async_entries_for_config_entry(ent_reg, entry.entry_id)
-    }
-    _LOGGER.info("ENTITIES ORPHAN %s", entities)
-    return
-
-    for entity in entry.data[CONF_ENTITIES]:
-        if entity[CONF_ID] in entities:
-            del entities[entity[CONF_ID]]
-
-    for entity_id in entities.values():
-        ent_reg.async_remove(entity_id)
@@ -32,6 +32,7 @@ from .const import (
     CONF_ENABLE_DEBUG,
     CONF_LOCAL_KEY,
     CONF_MODEL,
+    CONF_NO_CLOUD,
     CONF_PASSIVE_ENTITY,
     CONF_PROTOCOL_VERSION,
     CONF_RESET_DPIDS,
@@ -111,6 +112,11 @@ def get_dps_for_platform(flow_schema):
             yield key.schema
 
 
+def now_ms_str():
+    """Return the current time in milliseconds, as stored in ATTR_UPDATED_AT."""
+    return str(time.time_ns() // 1_000_000)
+
+
 def get_entity_config(config_entry, dp_id):
     """Return entity config for a given DPS id."""
     for entity in config_entry[CONF_ENTITIES]:
@@ -122,12 +128,10 @@ def get_entity_config(config_entry, dp_id):
 @callback
 def async_config_entry_by_device_id(hass, device_id):
     """Look up config entry by device id."""
-    current_entries = hass.config_entries.async_entries(DOMAIN)
-    for entry in current_entries:
-        if device_id in entry.data.get(CONF_DEVICES, []):
+    for entry in hass.config_entries.async_entries(DOMAIN):
+        if device_id in entry.data.get(CONF_DEVICES, {}):
             return entry
-        else:
-            _LOGGER.warning(f"Missing device configuration for device_id {device_id}")
+    _LOGGER.warning("Missing device configuration for device_id %s", device_id)
     return None
 
 
@@ -241,8 +245,17 @@ class TuyaDevice(pytuya.TuyaListener, pytuya.ContextualLogger):
                             self._interface = None
 
             except (UnicodeDecodeError, json.decoder.JSONDecodeError) as ex:
-                self.warning("Initial state update failed (%s), trying key update", ex)
-                await self.update_local_key()
+                if self._config_entry.data.get(CONF_NO_CLOUD, True):
+                    self.warning(
+                        "Initial state update failed (%s), local_key may be wrong "
+                        "and Cloud API is not configured",
+                        ex,
+                    )
+                else:
+                    self.warning(
+                        "Initial state update failed (%s), trying key update", ex
+                    )
+                    await self.update_local_key()
 
                 if self._interface is not None:
                     await self._interface.close()
@@ -290,7 +303,7 @@ class TuyaDevice(pytuya.TuyaListener, pytuya.ContextualLogger):
             self._local_key = cloud_devs[dev_id].get(CONF_LOCAL_KEY)
             new_data = self._config_entry.data.copy()
             new_data[CONF_DEVICES][dev_id][CONF_LOCAL_KEY] = self._local_key
-            new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+            new_data[ATTR_UPDATED_AT] = now_ms_str()
             self._hass.config_entries.async_update_entry(
                 self._config_entry,
                 data=new_data,
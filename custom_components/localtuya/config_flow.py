@@ -1,7 +1,6 @@
 """Config flow for LocalTuya integration integration."""
 import errno
 import logging
-import time
 from importlib import import_module
 
 import homeassistant.helpers.config_validation as cv
@@ -26,7 +25,7 @@ from homeassistant.const import (
 from homeassistant.core import callback
 
 from .cloud_api import TuyaCloudApi
-from .common import pytuya
+from .common import now_ms_str, pytuya
 from .const import (
     ATTR_UPDATED_AT,
     CONF_ACTION,
@@ -448,7 +447,7 @@ class LocalTuyaOptionsFlowHandler(config_entries.OptionsFlow):
                     if CONF_MODEL not in dev and dev_id in cloud_devs:
                         model = cloud_devs[dev_id].get(CONF_PRODUCT_NAME)
                         new_data[CONF_DEVICES][dev_id][CONF_MODEL] = model
-                new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+                new_data[ATTR_UPDATED_AT] = now_ms_str()
 
                 self.hass.config_entries.async_update_entry(
                     self.config_entry,
@@ -663,7 +662,7 @@ class LocalTuyaOptionsFlowHandler(config_entries.OptionsFlow):
                 dev_id = self.device_data.get(CONF_DEVICE_ID)
 
                 new_data = self.config_entry.data.copy()
-                new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+                new_data[ATTR_UPDATED_AT] = now_ms_str()
                 new_data[CONF_DEVICES].update({dev_id: config})
 
                 self.hass.config_entries.async_update_entry(
@@ -753,7 +752,7 @@ class LocalTuyaOptionsFlowHandler(config_entries.OptionsFlow):
                         ent_reg.async_remove(entity_id)
 
                     new_data[CONF_DEVICES][dev_id] = self.device_data
-                    new_data[ATTR_UPDATED_AT] = str(int(time.time() * 1000))
+                    new_data[ATTR_UPDATED_AT] = now_ms_str()
                     self.hass.config_entries.async_update_entry(
                         self.config_entry,
                         data=new_data,
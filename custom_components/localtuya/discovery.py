@@ -15,6 +15,7 @@ from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 _LOGGER = logging.getLogger(__name__)
 
 UDP_KEY = md5(b"yGAdlopoPVldABfn").digest()
+UDP_CIPHER = Cipher(algorithms.AES(UDP_KEY), modes.ECB(), default_backend())
 
 DEFAULT_TIMEOUT = 6.0
 
@@ -25,8 +26,7 @@ def decrypt_udp(message):
     def _unpad(data):
         return data[: -ord(data[len(data) - 1 :])]
 
-    cipher = Cipher(algorithms.AES(UDP_KEY), modes.ECB(), default_backend())
-    decryptor = cipher.decryptor()
+    decryptor = UDP_CIPHER.decryptor()
     return _unpad(decryptor.update(message) + decryptor.finalize()).decode()
 
 
@@ -71,8 +71,9 @@ class TuyaDiscovery(asyncio.DatagramProtocol):
 
     def device_found(self, device):
         """Discover a new device."""
-        if device.get("gwId") not in self.devices:
-            self.devices[device.get("gwId")] = device
+        gw_id = device.get("gwId")
+        if gw_id not in self.devices:
+            self.devices[gw_id] = device
             _LOGGER.debug("Discovered device: %s", device)
 
         if self._callback: